@@ -1,29 +1,949 @@
+import asyncio
+import functools
+import hashlib
+import html
+import importlib.util
+import json
+import mmap
+import os
+import queue
+import re
+import sys
+import sqlite3
+import threading
+import time
 import pya
+from array import array
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from pathlib import Path
 from datetime import datetime
-from openai import OpenAI
-from typing import List, Dict
+from typing import TYPE_CHECKING, AsyncIterator, BinaryIO, Callable, Coroutine, List, Dict, Optional, Tuple
 
-# Helper function for OpenAI API call
-def generate_ai_response(api_key: str, model_name: str, messages: List[Dict[str, str]]) -> str:
+# openai, httpx, yaml and numpy are slow to import; they are imported where they are used so that loading
+# the macro at KLayout startup stays fast
+if TYPE_CHECKING:
+    import numpy as np
+    from openai import AsyncOpenAI
+
+try:
+    import zstandard
+except ImportError:  # older chat histories are kept uncompressed
+    zstandard = None
+
+try:
+    import orjson
+except ImportError:  # fall back to the standard library encoder
+    orjson = None
+
+# Without numpy the semantic response cache is unavailable
+_HAS_NUMPY = importlib.util.find_spec("numpy") is not None
+
+# Location of the kAI configuration file
+CONFIG_PATH = Path(__file__).parent.parent / 'config.yml'
+
+# Maximum number of concurrent requests issued by a bulk replay
+BULK_CONCURRENCY = 20
+
+# Default number of most recent chat messages sent to OpenAI with each prompt
+MAX_CONTEXT_TURNS = 10
+
+# Number of messages dropped from the context window before the summary of older messages is updated
+SUMMARY_INTERVAL = 10
+
+# Messages not yet covered by the summary are sent in full, up to this many beyond the context window, e.g.
+# while the summary is being updated or when updating it fails
+MAX_UNSUMMARIZED_MESSAGES = 2 * SUMMARY_INTERVAL
+
+# Maximum number of responses kept in a response cache; the least recently used ones are evicted
+CACHE_MAX_ENTRIES = 10000
+
+# Size in bytes above which text files are read through a memory map
+MMAP_THRESHOLD = 1 << 20
+
+# Start of a chat history entry, e.g. "User [2024-09-20 12:00:00]: ..."
+_ENTRY_START = re.compile(rb'^\w+ \[', re.MULTILINE)
+
+# Start of a non-empty line, i.e. of a record in a JSONL chat history
+_RECORD_START = re.compile(rb'^(?=.)', re.MULTILINE)
+
+# Suffixes of the chat history files listed in the UI
+_HISTORY_SUFFIXES = ('.jsonl', '.txt') + (('.jsonl.zst', '.txt.zst') if zstandard else ())
+
+# Shared OpenAI clients, by API key, and the background event loop driving them
+_CLIENTS: Dict[str, "AsyncOpenAI"] = {}
+_loop: Optional[asyncio.AbstractEventLoop] = None
+
+# Response caches, by cache directory
+_RESPONSE_CACHES: Dict[Path, "ResponseCache"] = {}
+
+
+@functools.lru_cache(maxsize=4)
+def _parse_config(path: str, mtime_ns: int) -> Dict[str, str]:
+    """
+    Parse a YAML configuration file; results are cached per path and modification time.
+
+    Args:
+        path (str): Path of the configuration file.
+        mtime_ns (int): Modification time of the file, used as part of the cache key.
+
+    Returns:
+        dict: The parsed configuration data, empty if the file is not valid YAML.
+    """
+    import yaml
+    # The libyaml bindings are much faster, when available
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    with open(path, 'rb') as file:
+        try:
+            data = yaml.load(file, Loader=loader)
+        except yaml.YAMLError:
+            return {}
+    return data if isinstance(data, dict) else {}
+
+
+def read_config(config_path: Path) -> Dict[str, str]:
+    """
+    Read configuration data from a YAML file, re-parsing it only when the file has changed.
+
+    Args:
+        config_path (Path): Path of the configuration file.
+
+    Returns:
+        dict: A copy of the configuration data, empty if the file does not exist or is not valid YAML.
+    """
+    try:
+        mtime_ns = config_path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    return dict(_parse_config(str(config_path), mtime_ns))
+
+
+def get_client(api_key: str) -> "AsyncOpenAI":
+    """
+    Return the shared asynchronous OpenAI client for an API key, creating it on first use.
+
+    Each client is backed by a pooled ``httpx.AsyncClient`` so TCP/TLS connections are kept alive across
+    requests; HTTP/2 is used when the `h2` package is installed. Must be called from the background event loop.
+
+    Args:
+        api_key (str): The API key for OpenAI.
+
+    Returns:
+        AsyncOpenAI: The shared client.
+    """
+    if api_key not in _CLIENTS:
+        import httpx
+        from openai import AsyncOpenAI
+
+        _CLIENTS[api_key] = AsyncOpenAI(
+            api_key=api_key,
+            http_client=httpx.AsyncClient(
+                http2=importlib.util.find_spec("h2") is not None,
+                timeout=30,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+            )
+        )
+    return _CLIENTS[api_key]
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Return the event loop used for OpenAI calls, starting it on a daemon thread on first use.
+
+    Returns:
+        asyncio.AbstractEventLoop: The running background event loop.
+    """
+    global _loop
+    if _loop is None:
+        _loop = asyncio.new_event_loop()
+        threading.Thread(target=_loop.run_forever, name="kai-asyncio", daemon=True).start()
+    return _loop
+
+
+def cache_key(model_name: str, messages: List[Dict[str, str]]) -> str:
+    """
+    Compute the response cache key of a request.
+
+    Args:
+        model_name (str): The model name to be used.
+        messages (List[Dict[str, str]]): The messages sent to the model.
+
+    Returns:
+        str: The hex digest identifying the request.
+    """
+    request = json.dumps({"m": model_name, "msgs": messages}, sort_keys=True)
+    return hashlib.blake2b(request.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class ResponseCache:
+    """
+    SQLite store of generated responses by request key, evicting the least recently used ones.
+
+    Responses are kept in `cache.sqlite` in the cache directory. With the semantic cache, the normalized
+    embedding of the prompt is stored next to its response, so that near-duplicate prompts can be answered too.
+    A cache is only used from the background event loop thread.
+
+    Attributes:
+        max_entries (int): Maximum number of cached responses.
+        threshold (float): Minimum cosine similarity for a cached response to answer a different prompt.
+    """
+
+    EMBEDDING_MODEL = "text-embedding-3-small"
+
+    def __init__(self, cache_dir: Path, max_entries: int = CACHE_MAX_ENTRIES, threshold: float = 0.9):
+        """
+        Open the response cache in a cache directory, creating it if needed.
+
+        Args:
+            cache_dir (Path): The directory of the response cache.
+            max_entries (int): Maximum number of cached responses.
+            threshold (float): Minimum cosine similarity for a cached response to answer a different prompt.
+        """
+        self.max_entries = max_entries
+        self.threshold = threshold
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(cache_dir / 'cache.sqlite'), isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, embedding BLOB, response TEXT, ts REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS cache_ts ON cache (ts)")
+        # In-memory copy of the stored embeddings, loaded on the first semantic lookup; rows of evicted
+        # entries are zeroed and reused
+        self._rows: Optional[Dict[str, int]] = None
+        self._keys: List[Optional[str]] = []
+        self._free: List[int] = []
+        self._matrix = None
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Look up a cached response, marking it as recently used.
+
+        Args:
+            key (str): The request key, see `cache_key`.
+
+        Returns:
+            str: The cached response, or None on a cache miss.
+        """
+        row = self._db.execute("SELECT response FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self._db.execute("UPDATE cache SET ts = ? WHERE key = ?", (time.time(), key))
+        return row[0]
+
+    def get_similar(self, embedding: "np.ndarray") -> Optional[str]:
+        """
+        Look up the cached response to the most similar prompt.
+
+        The stored embeddings are loaded on the first lookup; `set` keeps them up to date afterwards.
+
+        Args:
+            embedding (np.ndarray): The normalized embedding of the prompt.
+
+        Returns:
+            str: The cached response, or None if no cached prompt is similar enough.
+        """
+        if self._rows is None:
+            self._load_embeddings()
+        if self._matrix is None or not self._keys or self._matrix.shape[1] != embedding.shape[0]:
+            return None
+        scores = self._matrix[:len(self._keys)] @ embedding
+        best = int(scores.argmax())
+        key = self._keys[best]
+        return self.get(key) if key is not None and scores[best] >= self.threshold else None
+
+    def set(self, key: str, response: str, embedding: Optional["np.ndarray"] = None) -> None:
+        """
+        Cache a response, then evict the least recently used responses beyond `max_entries`.
+
+        Args:
+            key (str): The request key, see `cache_key`.
+            response (str): The response to cache.
+            embedding (np.ndarray, optional): The normalized embedding of the prompt, for the semantic cache.
+        """
+        blob = embedding.astype('float32').tobytes() if embedding is not None else None
+        with self._db:
+            self._db.execute("BEGIN")
+            self._db.execute(
+                "INSERT OR REPLACE INTO cache (key, embedding, response, ts) VALUES (?, ?, ?, ?)",
+                (key, blob, response, time.time())
+            )
+            evicted = [
+                row[0] for row in
+                self._db.execute("SELECT key FROM cache ORDER BY ts DESC LIMIT -1 OFFSET ?", (self.max_entries,))
+            ]
+            self._db.executemany("DELETE FROM cache WHERE key = ?", [(evicted_key,) for evicted_key in evicted])
+
+        if self._rows is not None:
+            for evicted_key in evicted:
+                self._remove_embedding(evicted_key)
+            if embedding is not None:
+                self._add_embedding(key, embedding)
+            else:
+                self._remove_embedding(key)
+
+    def _load_embeddings(self) -> None:
+        """Load the stored embeddings into the in-memory matrix, skipping any of another dimension."""
+        import numpy as np
+
+        rows = self._db.execute("SELECT key, embedding FROM cache WHERE embedding IS NOT NULL").fetchall()
+        sizes = [len(blob) for _, blob in rows]
+        size = max(set(sizes), key=sizes.count) if sizes else 0
+        rows = [(key, blob) for key, blob in rows if len(blob) == size]
+        self._keys = [key for key, _ in rows]
+        self._rows = {key: row for row, key in enumerate(self._keys)}
+        self._free = []
+        self._matrix = None
+        if rows:
+            data = np.frombuffer(b''.join(blob for _, blob in rows), dtype=np.float32)
+            self._matrix = data.reshape(len(rows), size // 4).copy()
+
+    def _add_embedding(self, key: str, embedding: "np.ndarray") -> None:
+        """
+        Add or replace the embedding of a cache entry in the in-memory matrix.
+
+        Args:
+            key (str): The request key.
+            embedding (np.ndarray): The normalized embedding of the prompt.
+        """
+        import numpy as np
+
+        if self._matrix is not None and self._matrix.shape[1] != embedding.shape[0]:
+            self._rows = None  # the embedding model changed; reload on the next lookup
+            return
+        row = self._rows.get(key)
+        if row is None:
+            if self._free:
+                row = self._free.pop()
+            else:
+                row = len(self._keys)
+                self._keys.append(None)
+                if self._matrix is None:
+                    self._matrix = np.zeros((16, embedding.shape[0]), dtype=np.float32)
+                elif row == len(self._matrix):
+                    self._matrix = np.concatenate([self._matrix, np.zeros_like(self._matrix)])
+        self._matrix[row] = embedding
+        self._keys[row] = key
+        self._rows[key] = row
+
+    def _remove_embedding(self, key: str) -> None:
+        """
+        Remove the embedding of a cache entry from the in-memory matrix, if it has one.
+
+        Args:
+            key (str): The request key.
+        """
+        row = self._rows.pop(key, None)
+        if row is not None:
+            self._matrix[row] = 0
+            self._keys[row] = None
+            self._free.append(row)
+
+
+def get_response_cache(cache_dir: Path) -> ResponseCache:
+    """
+    Return the shared response cache of a cache directory, opening it on first use.
+
+    Args:
+        cache_dir (Path): The directory of the response cache.
+
+    Returns:
+        ResponseCache: The shared cache.
+    """
+    if cache_dir not in _RESPONSE_CACHES:
+        _RESPONSE_CACHES[cache_dir] = ResponseCache(cache_dir)
+    return _RESPONSE_CACHES[cache_dir]
+
+
+async def _embed(api_key: str, text: str) -> "np.ndarray":
+    """
+    Compute the normalized embedding of a text with OpenAI's API.
+
+    Args:
+        api_key (str): The API key for OpenAI.
+        text (str): The text to embed.
+
+    Returns:
+        np.ndarray: The unit-length float32 embedding.
+    """
+    import numpy as np
+
+    response = await get_client(api_key).embeddings.create(model=ResponseCache.EMBEDDING_MODEL, input=text)
+    embedding = np.asarray(response.data[0].embedding, dtype=np.float32)
+    return embedding / np.linalg.norm(embedding)
+
+
+async def _stream_completion(api_key: str, model_name: str, messages: List[Dict[str, str]]) -> AsyncIterator[str]:
+    """
+    Stream an AI response from OpenAI's API.
+
+    Args:
+        api_key (str): The API key for OpenAI.
+        model_name (str): The model name to be used.
+        messages (List[Dict[str, str]]): The conversation history with user input and AI responses.
+
+    Yields:
+        str: The chunks of response text, as they arrive.
+    """
+    stream = await get_client(api_key).chat.completions.create(
+        model=model_name,
+        messages=messages,
+        max_tokens=150,
+        stream=True
+    )
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+# Helper coroutine for OpenAI API call
+async def _generate(api_key: str, model_name: str, messages: List[Dict[str, str]],
+                    on_delta: Optional[Callable[[str], None]] = None, cache_dir: Optional[Path] = None,
+                    semantic: bool = False) -> str:
+    """
+    Generate AI response using OpenAI's API, streaming the tokens as they arrive.
+
+    Args:
+        api_key (str): The API key for OpenAI.
+        model_name (str): The model name to be used.
+        messages (List[Dict[str, str]]): The conversation history with user input and AI responses.
+        on_delta (Callable[[str], None], optional): Called from the event loop thread with each streamed chunk of text.
+        cache_dir (Path, optional): Directory of the response cache; identical requests are answered from it.
+        semantic (bool): Whether to also answer a request without earlier messages from the cache when its
+            prompt is similar to a cached one. Requires numpy and a `cache_dir`.
+
+    Returns:
+        str: The content of the AI response.
+    """
+    cache = None
+    if cache_dir is not None:
+        cache = get_response_cache(cache_dir)
+        key = cache_key(model_name, messages)
+        cached = cache.get(key)
+        embedding = None
+        # The response depends on the whole context; only a prompt sent on its own can stand in for a similar one
+        if cached is None and semantic and _HAS_NUMPY and len(messages) == 1:
+            try:
+                embedding = await _embed(api_key, messages[-1]['content'])
+            except Exception:
+                pass  # the semantic cache is only a shortcut; generate the response as usual
+            else:
+                cached = cache.get_similar(embedding)
+        if cached is not None:
+            if on_delta:
+                on_delta(cached)
+            return cached
+
+    parts = []
+    async for delta in _stream_completion(api_key, model_name, messages):
+        parts.append(delta)
+        if on_delta:
+            on_delta(delta)
+    response = "".join(parts).strip()
+    if cache is not None:
+        cache.set(key, response, embedding)
+    return response
+
+
+async def _await_response(future: Future, on_delta: Optional[Callable[[str], None]] = None) -> str:
+    """
+    Wait for a response that was requested ahead of time, e.g. speculatively while the prompt was typed.
+
+    Args:
+        future (Future): The request returning the AI response.
+        on_delta (Callable[[str], None], optional): Called from the event loop thread with the complete response.
+
+    Returns:
+        str: The content of the AI response.
+    """
+    response = await asyncio.wrap_future(future)
+    if on_delta:
+        on_delta(response)
+    return response
+
+
+async def _summarize(api_key: str, model_name: str, summary: str, messages: List[Dict[str, str]]) -> str:
+    """
+    Fold chat messages into a running summary of the conversation.
+
+    Args:
+        api_key (str): The API key for OpenAI.
+        model_name (str): The model name to be used.
+        summary (str): The summary so far, empty if there is none yet.
+        messages (List[Dict[str, str]]): The messages to add to the summary.
+
+    Returns:
+        str: The updated summary.
+    """
+    transcript = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+    response = await get_client(api_key).chat.completions.create(
+        model=model_name,
+        messages=[
+            {"role": "system", "content": "Summarize the conversation in a few sentences, keeping the facts "
+                                          "and decisions the assistant needs to continue it."},
+            {"role": "user", "content": f"Summary so far:\n{summary or '(none)'}\n\nNew messages:\n{transcript}"},
+        ],
+        max_tokens=150
+    )
+    return response.choices[0].message.content.strip()
+
+
+async def _generate_many(api_key: str, model_name: str, prompts: List[str]) -> list:
+    """
+    Generate AI responses for independent prompts concurrently.
+
+    The response cache is not used: replays are meant to run saved prompts again.
+
+    Args:
+        api_key (str): The API key for OpenAI.
+        model_name (str): The model name to be used.
+        prompts (List[str]): The prompts to send, each as a single-message conversation.
+
+    Returns:
+        list: The response for each prompt, or the exception raised for it.
+    """
+    semaphore = asyncio.Semaphore(BULK_CONCURRENCY)
+
+    async def generate_one(prompt: str) -> str:
+        async with semaphore:
+            return await _generate(api_key, model_name, [{"role": "user", "content": prompt}])
+
+    return await asyncio.gather(*(generate_one(prompt) for prompt in prompts), return_exceptions=True)
+
+
+class BatchError(RuntimeError):
+    """A Batch API batch finished without results: it failed, expired or was cancelled."""
+
+
+def _write_batch_record(record_path: Path, record: dict) -> None:
+    """
+    Save the record of a submitted batch.
+
+    Args:
+        record_path (Path): The record file, '<batch id>.json' in the batch directory.
+        record (dict): The batch record.
+    """
+    temp_path = record_path.with_name(record_path.name + '.tmp')
+    temp_path.write_text(json.dumps(record, ensure_ascii=False, indent=1), encoding='utf-8')
+    os.replace(temp_path, record_path)
+
+
+async def _submit_batch(api_key: str, model_name: str, prompts: List[str], batch_dir: Path) -> str:
+    """
+    Submit independent prompts to the OpenAI Batch API.
+
+    The request file is kept in `batch_dir`, next to a record of the batch ('<batch id>.json') from which
+    `_collect_batch` fetches the responses once the batch completes, in this session or a later one.
+
+    Args:
+        api_key (str): The API key for OpenAI.
+        model_name (str): The model name to be used.
+        prompts (List[str]): The prompts to send, each as a single-message conversation.
+        batch_dir (Path): Directory for the batch request, record and result files.
+
+    Returns:
+        str: The id of the batch.
+    """
+    client = get_client(api_key)
+    batch_dir.mkdir(parents=True, exist_ok=True)
+    input_path = batch_dir / f"batch_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl"
+    with open(input_path, 'w') as file:
+        for i, prompt in enumerate(prompts):
+            request = {
+                "custom_id": str(i),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {"model": model_name, "messages": [{"role": "user", "content": prompt}], "max_tokens": 150},
+            }
+            file.write(json.dumps(request) + '\n')
+
+    input_file = await client.files.create(file=input_path, purpose="batch")
+    batch = await client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    _write_batch_record(batch_dir / f"{batch.id}.json", {
+        "id": batch.id, "model": model_name, "input": input_path.name, "prompts": prompts, "collected": False
+    })
+    return batch.id
+
+
+async def _collect_batch(api_key: str, batch_dir: Path, batch_id: str) -> Optional[List[str]]:
+    """
+    Fetch the responses of a submitted batch if it has finished, marking its record as collected.
+
+    The downloaded results are kept in `batch_dir` as '<batch id>_output.jsonl'.
+
+    Args:
+        api_key (str): The API key for OpenAI.
+        batch_dir (Path): Directory of the batch record and result files.
+        batch_id (str): The id of the batch.
+
+    Returns:
+        List[str]: The response for each prompt, empty where the request failed, or None while the batch
+            is still running.
+
+    Raises:
+        BatchError: If the batch failed, expired or was cancelled.
+    """
+    client = get_client(api_key)
+    batch = await client.batches.retrieve(batch_id)
+    if batch.status not in ("completed", "failed", "expired", "cancelled"):
+        return None
+
+    record_path = batch_dir / f"{batch_id}.json"
+    record = json.loads(record_path.read_text(encoding='utf-8'))
+    record["collected"] = True
+    if batch.status != "completed" or not batch.output_file_id:
+        _write_batch_record(record_path, record)
+        raise BatchError(f"Batch {batch_id} finished with status '{batch.status}'")
+
+    output = (await client.files.content(batch.output_file_id)).text
+    (batch_dir / f"{batch_id}_output.jsonl").write_text(output)
+    _write_batch_record(record_path, record)
+
+    results = [""] * len(record["prompts"])
+    for line in output.splitlines():
+        result = json.loads(line)
+        response = result.get("response")
+        if response and response["status_code"] == 200:
+            results[int(result["custom_id"])] = response["body"]["choices"][0]["message"]["content"].strip()
+    return results
+
+
+def read_compressed(file_path: Path) -> bytes:
+    """
+    Read and decompress a zstd-compressed file.
+
+    Files whose frame header records the decompressed size are decompressed in one call into a buffer of
+    that size; others are streamed.
+
+    Args:
+        file_path (Path): The compressed file.
+
+    Returns:
+        bytes: The decompressed contents.
+    """
+    data = file_path.read_bytes()
+    if zstandard.frame_content_size(data) >= 0:
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zstandard.ZstdDecompressor().stream_reader(data).readall()
+
+
+def compress_file(file_path: Path) -> Path:
+    """
+    Compress a file with zstd next to the original, then remove the original.
+
+    Args:
+        file_path (Path): The file to compress.
+
+    Returns:
+        Path: The compressed file, named after the original with a '.zst' suffix.
+    """
+    compressed_path = file_path.with_name(file_path.name + '.zst')
+    temp_path = compressed_path.with_name(compressed_path.name + '.tmp')
+    with open(file_path, 'rb') as source, open(temp_path, 'wb') as target:
+        # Record the size in the frame header, so that reading the file back needs a single allocation
+        zstandard.ZstdCompressor(level=3).copy_stream(source, target, size=os.fstat(source.fileno()).st_size)
+    os.replace(temp_path, compressed_path)
+    file_path.unlink()
+    return compressed_path
+
+
+def update_history_index(history_dir: Path, name: str, first_line: str, turns: int) -> None:
+    """
+    Record the summary of a chat history file in the history directory's index.json.
+
+    Args:
+        history_dir (Path): The history directory.
+        name (str): The name of the chat history, as listed in the UI.
+        first_line (str): The first line of the chat history.
+        turns (int): The number of user prompts in the chat history.
+    """
+    index_path = history_dir / 'index.json'
+    index = json.loads(index_path.read_text()) if index_path.exists() else {}
+    index[name] = {"first_line": first_line, "turns": turns}
+    temp_path = index_path.with_name(index_path.name + '.tmp')
+    temp_path.write_text(json.dumps(index, indent=1))
+    os.replace(temp_path, index_path)
+
+
+def dump_record(role: str, timestamp: str, content: str) -> bytes:
+    """
+    Serialize a chat message as a JSONL chat history record.
+
+    Args:
+        role (str): The message role, e.g. 'user' or 'assistant'.
+        timestamp (str): The message timestamp.
+        content (str): The message content.
+
+    Returns:
+        bytes: The UTF-8 encoded record, including the trailing newline.
+    """
+    record = {"t": timestamp, "role": role, "c": content}
+    if orjson:
+        return orjson.dumps(record) + b"\n"
+    return json.dumps(record, ensure_ascii=False).encode('utf-8') + b"\n"
+
+
+def load_record(line: bytes) -> Dict[str, str]:
+    """
+    Parse a JSONL chat history record.
+
+    Args:
+        line (bytes): The encoded record.
+
+    Returns:
+        dict: The record, with the keys 't' (timestamp), 'role' and 'c' (content).
+    """
+    return orjson.loads(line) if orjson else json.loads(line)
+
+
+def format_entry(label: str, timestamp: str, content: str) -> str:
+    """
+    Format a labelled, timestamped entry for display.
+
+    Args:
+        label (str): The entry label, e.g. "User" or "AI".
+        timestamp (str): The timestamp of the entry.
+        content (str): The text of the entry.
+
+    Returns:
+        str: The entry, e.g. "User [2024-09-20 12:00:00]: ...".
+    """
+    return f"{label} [{timestamp}]: {content}"
+
+
+def format_record(record: Dict[str, str]) -> str:
+    """
+    Format a chat history record for display.
+
+    Args:
+        record (dict): The record, as returned by `load_record`.
+
+    Returns:
+        str: The entry, e.g. "User [2024-09-20 12:00:00]: ...".
     """
-    Generate AI response using OpenAI's API.
+    return format_entry(record['role'].capitalize(), record['t'], record['c'])
+
+
+def read_text(file_path: Path) -> str:
+    """
+    Read a UTF-8 text file in a single call.
+
+    Files larger than `MMAP_THRESHOLD` are decoded straight from a memory map, which avoids copying them into
+    an intermediate buffer; zstd-compressed files ('.zst') are decompressed in memory instead.
 
     Args:
-        api_key (str): The API key for OpenAI.
-        model_name (str): The model name to be used.
-        messages (List[Dict[str, str]]): The conversation history with user input and AI responses.
+        file_path (Path): The file to read.
 
     Returns:
-        str: The content of the AI response.
+        str: The file contents, with undecodable bytes replaced.
     """
-    client = OpenAI(api_key=api_key)
-    response = client.chat.completions.create(
-        model=model_name,
-        messages=messages,  # Pass the entire chat history
-        max_tokens=150
-    )
-    return response.choices[0].message.content.strip()
+    if file_path.suffix == '.zst':
+        return read_compressed(file_path).decode('utf-8', 'replace')
+    with open(file_path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size <= MMAP_THRESHOLD:
+            return file.read().decode('utf-8', 'replace')
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return str(mapped, 'utf-8', 'replace')
+
+
+def parse_user_prompts(history_content: str) -> List[str]:
+    """
+    Extract the user prompts from a saved plain text chat history.
+
+    Args:
+        history_content (str): The contents of a chat history file.
+
+    Returns:
+        List[str]: The user prompts, in order.
+    """
+    return re.findall(r'^User \[[^\]]*\]: (.*)$', history_content, re.MULTILINE)
+
+
+def read_user_prompts(file_path: Path) -> List[str]:
+    """
+    Read the user prompts from a saved chat history, in JSONL or plain text format.
+
+    Args:
+        file_path (Path): The chat history file.
+
+    Returns:
+        List[str]: The user prompts, in order.
+    """
+    if '.jsonl' not in file_path.name:
+        return parse_user_prompts(read_text(file_path))
+    # Text after the last newline is an incomplete record of a history that is still being written
+    records = (load_record(line) for line in read_text(file_path).split('\n')[:-1] if line)
+    return [record['c'] for record in records if record['role'] == 'user']
+
+
+def _html_span(text: str, color: str) -> str:
+    """
+    Render text as a colored HTML span for the output display.
+
+    Whitespace is preserved so that streamed chunks join up exactly.
+
+    Args:
+        text (str): The text to render.
+        color (str): The text color.
+
+    Returns:
+        str: The escaped HTML.
+    """
+    return f'<span style="color:{color}; white-space:pre-wrap">{html.escape(text).replace(chr(10), "<br>")}</span>'
+
+
+class TranscriptModel(pya.QAbstractListModel):
+    """
+    A list model exposing the entries of a chat history file, fetched page by page as the view scrolls.
+
+    The file is memory-mapped (or decompressed in memory when zstd-compressed) and only scanned for entry
+    boundaries as far as rows have been fetched; row text is decoded when the view asks for it. JSONL
+    histories with an '.idx' sidecar of record offsets are not scanned at all.
+    """
+
+    PAGE_SIZE = 200
+
+    def __init__(self, file_path: Path, index_path: Optional[Path] = None):
+        """
+        Open a chat history file.
+
+        Args:
+            file_path (Path): The chat history file to display.
+            index_path (Path, optional): The '.idx' sidecar with the record offsets of a JSONL history.
+        """
+        super().__init__()
+        if file_path.suffix == '.zst':
+            self._file = None
+            self._data = read_compressed(file_path)
+            size = len(self._data)
+        else:
+            self._file = open(file_path, 'rb')
+            size = os.fstat(self._file.fileno()).st_size
+            self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        self._jsonl = '.jsonl' in file_path.name
+        self._matches = (_RECORD_START if self._jsonl else _ENTRY_START).finditer(self._data)
+        self._starts = [0] if size else []
+        self._exhausted = not size
+        self._row_count = 0
+        if size and index_path is not None and index_path.exists():
+            offsets = array('Q')
+            offsets.frombytes(index_path.read_bytes())
+            if offsets and offsets[-1] < size:
+                self._matches = iter(())
+                self._starts = offsets.tolist()
+                self._exhausted = True
+
+    def _scan(self, count: int) -> None:
+        """
+        Find the start offsets of up to `count` more entries.
+
+        Args:
+            count (int): The number of entries to look for.
+        """
+        found = 0
+        for match in self._matches:
+            if match.start() == 0:
+                continue
+            self._starts.append(match.start())
+            found += 1
+            if found == count:
+                return
+        self._exhausted = True
+
+    def _available(self) -> int:
+        """Return the number of entries whose end offset is known."""
+        return len(self._starts) if self._exhausted else len(self._starts) - 1
+
+    def rowCount(self, parent: pya.QModelIndex) -> int:
+        return 0 if parent.isValid() else self._row_count
+
+    def data(self, index: pya.QModelIndex, role: int):
+        if not index.isValid() or role != pya.Qt.DisplayRole:
+            return None
+        row = index.row()
+        end = self._starts[row + 1] if row + 1 < len(self._starts) else len(self._data)
+        if self._jsonl:
+            line = self._data[self._starts[row]:end]
+            try:
+                return format_record(load_record(line))
+            except (ValueError, KeyError, TypeError):
+                # e.g. the last record of a history that is still being written
+                return line.decode('utf-8', 'replace').rstrip('\n')
+        text = self._data[self._starts[row]:end].decode('utf-8', 'replace')
+        return "\n".join(line for line in text.splitlines() if line != "===")
+
+    def canFetchMore(self, parent: pya.QModelIndex) -> bool:
+        return not parent.isValid() and (self._row_count < self._available() or not self._exhausted)
+
+    def fetchMore(self, parent: pya.QModelIndex) -> None:
+        self._scan(self.PAGE_SIZE)
+        available = min(self._available(), self._row_count + self.PAGE_SIZE)
+        if available > self._row_count:
+            self.beginInsertRows(pya.QModelIndex(), self._row_count, available - 1)
+            self._row_count = available
+            self.endInsertRows()
+
+    def close(self) -> None:
+        """Release the memory-mapped file."""
+        self._matches = None
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        if self._file is not None:
+            self._file.close()
+
+
+class HistoryListModel(pya.QAbstractListModel):
+    """
+    A list model of chat history names, replaced with a single model reset when the history changes.
+    """
+
+    def __init__(self):
+        """Create an empty history list."""
+        super().__init__()
+        self._names: List[str] = []
+        self._tooltips: Dict[str, str] = {}
+
+    def set_names(self, names: List[str], tooltips: Dict[str, str]) -> None:
+        """
+        Replace the listed chat histories.
+
+        Args:
+            names (List[str]): The chat history names, in display order.
+            tooltips (Dict[str, str]): Tooltip text per name, where available.
+        """
+        self.beginResetModel()
+        self._names = names
+        self._tooltips = tooltips
+        self.endResetModel()
+
+    def name(self, row: int) -> str:
+        """
+        Return the chat history name at a row.
+
+        Args:
+            row (int): The row in the list.
+
+        Returns:
+            str: The chat history name.
+        """
+        return self._names[row]
+
+    def rowCount(self, parent: pya.QModelIndex) -> int:
+        return 0 if parent.isValid() else len(self._names)
+
+    def data(self, index: pya.QModelIndex, role: int):
+        if not index.isValid():
+            return None
+        name = self._names[index.row()]
+        if role == pya.Qt.DisplayRole:
+            return name
+        if role == pya.Qt.ToolTipRole:
+            return self._tooltips.get(name)
+        return None
 
 
 class kai_ui(pya.QDialog):
@@ -33,9 +953,49 @@ class kai_ui(pya.QDialog):
     Attributes:
         api_key (str): The OpenAI API key.
         model_name (str): The model name for AI response generation.
+        max_context_turns (int): Number of most recent chat messages sent with each prompt.
+        semantic_cache (bool): Whether lone prompts similar to cached ones are answered from the response cache.
+        speculative_prefetch (bool): Whether responses are requested while the prompt is typed.
+        summary_model (str): The model name used to summarize messages that left the context window.
         config_data (dict): Configuration data from the config file.
-        chat_history (list): List to store user and AI messages.
+        chat_history (list): List to store user and AI messages, each stamped with the time of its exchange.
         history_dir (Path): Directory for storing chat history files.
+        cache_dir (Path): Directory of the response cache.
+        loop (asyncio.AbstractEventLoop): Background event loop running the OpenAI requests.
+    """
+
+    USER_COLOR = "black"
+    AI_COLOR = "green"
+
+    # Qt style sheet of the dialog; the history and config dialogs are its children and inherit it
+    _STYLESHEET = """
+        QDialog {
+            background-color: #f0f0f0;
+        }
+        QLineEdit, QTextEdit {
+            font-size: 14px;
+            padding: 8px;
+            border: 1px solid #ccc;
+            border-radius: 5px;
+        }
+        QPushButton {
+            background-color: #f15025;
+            color: white;
+            font-size: 14px;
+            padding: 10px;
+            border-radius: 5px;
+        }
+        QPushButton:hover {
+            background-color: #005fa3;
+        }
+        QLabel {
+            font-size: 14px;
+            color: #333333;
+        }
+        QListView#history_list {
+            min-width: 200px;
+            max-width: 100px;
+        }
     """
 
     def __init__(self):
@@ -44,48 +1004,57 @@ class kai_ui(pya.QDialog):
         self.api_key = None
         self.setWindowTitle("kAI Assistant")
         self.resize(800, 400)
-        self.setStyleSheet(self.get_stylesheet())
+        self.setStyleSheet(self._STYLESHEET)
         self.config_data = self.load_config()
         self.chat_history = []
+        self._summary = ""
+        self._summary_upto = 0
+        self._summarizing = False
         self.history_dir = Path(__file__).parent.parent / 'history'
+        self.cache_dir = self.history_dir / '.cache'
+        self.batch_dir = self.history_dir / 'batches'
+        self._session_ts = datetime.now().strftime('%Y%m%d_%H%M%S')
+        self._complete_path = self.history_dir / f'kai_complete_{self._session_ts}.jsonl'
+        self._complete_file: Optional[BinaryIO] = None
+        self._complete_offsets = array('Q')
+        self._complete_size = 0
+        self._complete_turns = 0
+        self._flush_timer = pya.QTimer(self)
+        self._flush_timer.setInterval(2000)
+        self._flush_timer.timeout.connect(self.flush_chat_history)
+        self._flush_timer.start()
+        # Chat history files are written on a single worker thread, which keeps the writes in order
+        self._io_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="kai-io")
+        self.loop = get_event_loop()
+        self._ui_calls = queue.Queue()
+        self._pending = 0
+        # Whether a response is streaming into the output, and the output held back meanwhile
+        self._streaming = False
+        self._deferred_output: List[Callable[[], None]] = []
+        self._response_timer = pya.QTimer(self)
+        self._response_timer.setInterval(50)
+        self._response_timer.timeout.connect(self.process_responses)
+        self._history_cache: Dict[str, str] = {}
+        # Batch API batches are checked every minute until their responses are collected
+        self._collecting = set()
+        self._batch_timer = pya.QTimer(self)
+        self._batch_timer.setInterval(60000)
+        self._batch_timer.timeout.connect(self.collect_batches)
+        # Speculative request for the prompt being typed, with the messages it was sent
+        self._speculative: Optional[Tuple[List[Dict[str, str]], Future]] = None
+        self._prefetch_timer = pya.QTimer(self)
+        self._prefetch_timer.setSingleShot(True)
+        self._prefetch_timer.setInterval(300)
+        self._prefetch_timer.timeout.connect(self.prefetch_response)
         self.init_ui()
 
-    def get_stylesheet(self) -> str:
-        """
-        Define and return the stylesheet for the UI.
+        # Refresh the history list only when the history directory changes
+        self.history_dir.mkdir(exist_ok=True)
+        self._fs_watcher = pya.QFileSystemWatcher([str(self.history_dir)], self)
+        self._fs_watcher.directoryChanged.connect(self.on_history_dir_changed)
 
-        Returns:
-            str: The CSS style rules.
-        """
-        return """
-            QDialog {
-                background-color: #f0f0f0;
-            }
-            QLineEdit, QTextEdit {
-                font-size: 14px;
-                padding: 8px;
-                border: 1px solid #ccc;
-                border-radius: 5px;
-            }
-            QPushButton {
-                background-color: #f15025;
-                color: white;
-                font-size: 14px;
-                padding: 10px;
-                border-radius: 5px;
-            }
-            QPushButton:hover {
-                background-color: #005fa3;
-            }
-            QLabel {
-                font-size: 14px;
-                color: #333333;
-            }
-            QListWidget {
-                min-width: 200px;
-                max-width: 100px;
-            }
-        """
+        # Collect the batches submitted in earlier sessions
+        self.collect_batches()
 
     def init_ui(self) -> None:
         """Initialize the UI layout with input/output fields and history panel."""
@@ -111,15 +1080,17 @@ class kai_ui(pya.QDialog):
 
         self.user_input = pya.QLineEdit(self)
         self.user_input.setPlaceholderText("Enter your prompt here...")
+        self.user_input.textChanged.connect(self.on_input_changed)
         left_layout.addWidget(self.user_input)
 
         self.output_area = pya.QTextEdit(self)
         self.output_area.setReadOnly(True)
+        self.output_area.setUndoRedoEnabled(False)
         left_layout.addWidget(self.output_area)
 
-        submit_button = pya.QPushButton("Submit", self)
-        submit_button.clicked.connect(self.on_submit)
-        left_layout.addWidget(submit_button)
+        self.submit_button = pya.QPushButton("Submit", self)
+        self.submit_button.clicked.connect(self.on_submit)
+        left_layout.addWidget(self.submit_button)
 
         self.config_display = pya.QLabel(self)
         left_layout.addWidget(self.config_display)
@@ -137,7 +1108,11 @@ class kai_ui(pya.QDialog):
         right_layout = pya.QVBoxLayout()
 
         right_layout.addWidget(pya.QLabel("Chat History (Complete)"))
-        self.history_list = pya.QListWidget(self)
+        self.history_model = HistoryListModel()
+        self.history_list = pya.QListView(self)
+        self.history_list.setObjectName("history_list")
+        self.history_list.setUniformItemSizes(True)
+        self.history_list.setModel(self.history_model)
         self.load_history_files()
         right_layout.addWidget(self.history_list)
 
@@ -145,6 +1120,14 @@ class kai_ui(pya.QDialog):
         load_button.clicked.connect(self.load_selected_history)
         right_layout.addWidget(load_button)
 
+        self.replay_button = pya.QPushButton("Replay Selected", self)
+        self.replay_button.clicked.connect(self.replay_selected_history)
+        right_layout.addWidget(self.replay_button)
+
+        self.batch_replay_button = pya.QPushButton("Batch Replay Selected", self)
+        self.batch_replay_button.clicked.connect(self.batch_replay_selected_history)
+        right_layout.addWidget(self.batch_replay_button)
+
         view_config_button = pya.QPushButton("View Config", self)
         view_config_button.clicked.connect(self.view_config_file)
         right_layout.addWidget(view_config_button)
@@ -158,60 +1141,409 @@ class kai_ui(pya.QDialog):
         Returns:
             dict: Configuration data including API key and model name.
         """
-        config_path = Path(__file__).parent.parent / 'config.yml'
-        config_data = {}
-        if config_path.exists():
-            with open(config_path, 'r') as file:
-                for line in file:
-                    if ':' in line:
-                        key, value = line.split(':', 1)
-                        config_data[key.strip()] = value.strip()
-        self.api_key = config_data.get('api_key', 'Not set')
-        self.model_name = config_data.get('model_name', 'Not set')
+        config_data = read_config(CONFIG_PATH)
+        self.api_key = str(config_data.get('api_key') or 'Not set')
+        self.model_name = str(config_data.get('model_name') or 'Not set')
+        self._api_key_ok = self.api_key not in ('null', 'Not set')
+        self._model_name_ok = self.model_name not in ('null', 'Not set')
+        try:
+            self.max_context_turns = max(int(config_data.get('max_context_turns') or MAX_CONTEXT_TURNS), 1)
+        except (TypeError, ValueError):
+            self.max_context_turns = MAX_CONTEXT_TURNS
+        self.semantic_cache = bool(config_data.get('semantic_cache', False))
+        self.summary_model = str(config_data.get('summary_model') or self.model_name)
+        self.speculative_prefetch = bool(config_data.get('speculative_prefetch', False))
         return config_data
 
     def update_config_display(self) -> None:
         """
         Update the UI to display the current API key and model configuration status.
         """
-        api_key_display = "API Key: Configured" if self.api_key != 'null' and self.api_key != 'Not set' else "API Key: Not Configured"
-        self.config_display.setText(f"{api_key_display}\nModel Name: {self.config_data.get('model_name', 'Not set')}")
-        self.config_display.setStyleSheet("color: black;" if api_key_display != "API Key: Not Configured" else "color: red;")
+        api_key_display = "API Key: Configured" if self._api_key_ok else "API Key: Not Configured"
+        self.config_display.setText(f"{api_key_display}\nModel Name: {self.model_name}")
+        self.config_display.setStyleSheet("color: black;" if self._api_key_ok and self._model_name_ok else "color: red;")
 
     def on_submit(self) -> None:
         """
-        Handle the submit button click event, sending user input to OpenAI and updating the UI with the response.
+        Handle the submit button click event, dispatching user input to OpenAI without blocking the UI.
+        """
+        prompt = self.user_input.text
+        if prompt and self._api_key_ok and self._model_name_ok:
+            timestamp = self.get_timestamp()
+            self.chat_history.append({"role": "user", "content": prompt, "ts": timestamp})
+            self.append_to_output(format_entry("User", timestamp, prompt))
+            self.append_to_output(format_entry("AI", timestamp, ""), is_ai=True)
+
+            messages = self.context_messages()
+            self._prefetch_timer.stop()
+            speculative, self._speculative = self._speculative, None
+            if speculative is not None and speculative[0] == messages:
+                coroutine = _await_response(speculative[1], self.queue_delta)
+            else:
+                if speculative is not None:
+                    speculative[1].cancel()
+                coroutine = _generate(
+                    self.api_key, self.model_name, messages, self.queue_delta, self.cache_dir, self.semantic_cache
+                )
+
+            # One prompt at a time, so that responses stream into the output in order
+            self.set_streaming(True)
+            self.submit_async(coroutine, lambda future: self.show_response(timestamp, prompt, future))
+
+    def on_input_changed(self, text: str) -> None:
+        """
+        Handle edits of the prompt, scheduling a speculative request once typing pauses.
+
+        Args:
+            text (str): The current prompt.
+        """
+        if self.speculative_prefetch:
+            self._prefetch_timer.start()
+
+    def prefetch_response(self) -> None:
+        """
+        Request the response to the prompt being typed ahead of time; runs 300 ms after the last edit.
+
+        The request goes through the response cache like a submitted prompt, so a cached response is found
+        before the prompt is submitted. Submitting the same prompt reuses the request, finished or not; a
+        request for a prompt that was edited further is cancelled.
         """
         prompt = self.user_input.text
-        if prompt and self.api_key != 'Not set':
-            self.chat_history.append({"role": "user", "content": prompt})
-            user_entry = f"User [{self.get_timestamp()}]: {prompt}"
-            self.append_to_output(user_entry)
+        if not (prompt and self._api_key_ok and self._model_name_ok and not self._streaming):
+            return
+        messages = self.context_messages(prompt)
+        if self._speculative is not None:
+            if self._speculative[0] == messages:
+                return
+            self._speculative[1].cancel()
+        future = asyncio.run_coroutine_threadsafe(
+            _generate(
+                self.api_key, self.model_name, messages, cache_dir=self.cache_dir, semantic=self.semantic_cache
+            ),
+            self.loop
+        )
+        self._speculative = (messages, future)
+
+    def context_messages(self, prompt: Optional[str] = None) -> List[Dict[str, str]]:
+        """
+        Return the messages to send with the next prompt: the messages of the chat history that the summary
+        does not cover yet, preceded by the summary once there is one.
+
+        The summary is created in the background, with `summary_model`, once messages start leaving the context
+        window, then updated every `SUMMARY_INTERVAL` messages. Until it covers them, messages that left the
+        window are still sent, up to `MAX_UNSUMMARIZED_MESSAGES` of them, so that none is silently lost.
+
+        Args:
+            prompt (str, optional): A prompt that is not in the chat history yet, sent as if it had been submitted.
+                Used for speculative requests, which leave the summary alone.
+
+        Returns:
+            List[Dict[str, str]]: The messages to send.
+        """
+        history = self.chat_history if prompt is None else self.chat_history + [{"role": "user", "content": prompt}]
+        start = max(self._summary_upto, len(history) - self.max_context_turns - MAX_UNSUMMARIZED_MESSAGES)
+        window = [{"role": message["role"], "content": message["content"]} for message in history[start:]]
+        dropped = max(len(history) - self.max_context_turns, 0)
+        pending = dropped - self._summary_upto
+        if prompt is None and pending > 0 and (pending >= SUMMARY_INTERVAL or not self._summary) and not self._summarizing:
+            self._summarizing = True
+            self.submit_async(
+                _summarize(self.api_key, self.summary_model, self._summary, self.chat_history[self._summary_upto:dropped]),
+                lambda future: self.update_summary(dropped, future)
+            )
+        if self._summary:
+            return [{"role": "system", "content": f"Summary of the earlier conversation: {self._summary}"}] + window
+        return window
+
+    def update_summary(self, upto: int, future: Future) -> None:
+        """
+        Store an updated summary of the older chat messages.
+
+        Args:
+            upto (int): The number of chat history messages the summary covers.
+            future (Future): The finished request returning the summary.
+        """
+        self._summarizing = False
+        try:
+            self._summary = future.result()
+            self._summary_upto = upto
+        except Exception:
+            pass  # keep the previous summary; the update is retried with the next prompt
+
+    def bulk_submit(self, prompts: List[str]) -> None:
+        """
+        Send independent prompts to OpenAI concurrently and display the responses together.
+
+        Args:
+            prompts (List[str]): The prompts to send.
+        """
+        if prompts and self._api_key_ok and self._model_name_ok:
+            self.submit_async(
+                _generate_many(self.api_key, self.model_name, prompts),
+                lambda future: self.show_replay(prompts, future)
+            )
+
+    def batch_submit(self, prompts: List[str]) -> None:
+        """
+        Send independent prompts through the OpenAI Batch API.
+
+        The batch is recorded in the batch directory; its responses are displayed by `collect_batches` once it
+        completes, in this session or a later one.
+
+        Args:
+            prompts (List[str]): The prompts to send.
+        """
+        if prompts and self._api_key_ok and self._model_name_ok:
+            self.submit_async(
+                _submit_batch(self.api_key, self.model_name, prompts, self.batch_dir),
+                lambda future: self.show_batch_submitted(len(prompts), future)
+            )
+
+    def show_batch_submitted(self, count: int, future: Future) -> None:
+        """
+        Display a submitted batch and start checking it for completion.
+
+        Args:
+            count (int): The number of prompts in the batch.
+            future (Future): The finished request returning the batch id.
+        """
+        if self._streaming:
+            self._deferred_output.append(lambda: self.show_batch_submitted(count, future))
+            return
+        timestamp = self.get_timestamp()
+        try:
+            batch_id = future.result()
+        except Exception as e:
+            self.append_to_output(format_entry("Error", timestamp, str(e)))
+        else:
+            message = f"{count} prompt(s) submitted as {batch_id}; the responses are shown when it completes"
+            self.append_to_output(format_entry("Batch", timestamp, message))
+            self._batch_timer.start()
+        self.append_to_output("===")
+
+    def pending_batches(self) -> List[dict]:
+        """
+        Read the records of the submitted batches whose responses have not been collected yet.
+
+        Returns:
+            List[dict]: The batch records.
+        """
+        records = []
+        if self.batch_dir.exists():
+            with os.scandir(self.batch_dir) as entries:
+                for entry in entries:
+                    if entry.name.endswith('.json') and entry.is_file():
+                        try:
+                            record = json.loads(Path(entry.path).read_text(encoding='utf-8'))
+                        except ValueError:
+                            continue
+                        if not record.get("collected"):
+                            records.append(record)
+        return records
+
+    def collect_batches(self) -> None:
+        """
+        Check the batches whose responses have not been collected yet, displaying those that completed.
+
+        Runs from the batch timer, which stops once no batch is left.
+        """
+        pending = self.pending_batches()
+        if not pending:
+            self._batch_timer.stop()
+            return
+        self._batch_timer.start()
+        if not self._api_key_ok:
+            return
+        for record in pending:
+            if record["id"] not in self._collecting:
+                self._collecting.add(record["id"])
+                self.submit_async(
+                    _collect_batch(self.api_key, self.batch_dir, record["id"]),
+                    lambda future, record=record: self.show_batch_result(record, future)
+                )
+
+    def show_batch_result(self, record: dict, future: Future) -> None:
+        """
+        Display the responses of a completed batch.
+
+        Args:
+            record (dict): The batch record.
+            future (Future): The finished check returning the responses, or None if the batch is still running.
+        """
+        self._collecting.discard(record["id"])
+        try:
+            responses = future.result()
+        except BatchError:
+            pass  # displayed by show_replay
+        except Exception as e:
+            # e.g. a network error; the batch is checked again with the next tick of the batch timer
+            print(f"kAI: failed to check batch {record['id']}: {e!r}", file=sys.stderr)
+            return
+        else:
+            if responses is None:
+                return
+        self.show_replay(record["prompts"], future)
+
+    def submit_async(self, coroutine: Coroutine, handler: Callable[[Future], None]) -> None:
+        """
+        Run a coroutine on the background event loop and hand its result to `handler` on the UI thread.
+
+        Args:
+            coroutine (Coroutine): The coroutine to run.
+            handler (Callable[[Future], None]): Called with the finished future from `process_responses`.
+        """
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        future.add_done_callback(lambda f: self._ui_calls.put(lambda: self.complete_request(handler, f)))
+        self._pending += 1
+        self._response_timer.start()
+
+    def queue_delta(self, delta: str) -> None:
+        """
+        Queue a streamed chunk of AI response for display; safe to call from the event loop thread.
+
+        Args:
+            delta (str): The streamed text.
+        """
+        self._ui_calls.put(delta)
+
+    def process_responses(self) -> None:
+        """
+        Run the UI updates queued by background requests; runs on the UI thread from the response timer.
+
+        Consecutive streamed chunks are written to the output display in a single append.
+        """
+        deltas = []
+        while True:
+            try:
+                ui_call = self._ui_calls.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(ui_call, str):
+                deltas.append((ui_call, True))
+                continue
+            if deltas:
+                self.append_many_to_output(deltas)
+                deltas = []
+            ui_call()
+        if deltas:
+            self.append_many_to_output(deltas)
+
+        if self._pending <= 0:
+            self._response_timer.stop()
+
+    def complete_request(self, handler: Callable[[Future], None], future: Future) -> None:
+        """
+        Mark a background request as finished and pass it to its handler.
+
+        Args:
+            handler (Callable[[Future], None]): The handler given to `submit_async`.
+            future (Future): The finished request.
+        """
+        self._pending -= 1
+        handler(future)
 
-            response = generate_ai_response(self.api_key, self.model_name, self.chat_history)
+    def show_response(self, timestamp: str, prompt: str, future: Future) -> None:
+        """
+        Finish the streamed AI response to a submitted prompt and store it.
+
+        Args:
+            timestamp (str): The timestamp of the exchange.
+            prompt (str): The user's prompt.
+            future (Future): The finished request returning the complete AI response.
+        """
+        try:
+            response = future.result()
+        except Exception as e:
+            self.append_to_output(format_entry("Error", timestamp, str(e)))
+            self.append_to_output("===")
+        else:
+            self.chat_history.append({"role": "assistant", "content": response, "ts": timestamp})
+            self.append_to_output("===")
+            self.store_chat_history(timestamp, prompt, response)
+        self.set_streaming(False)
+
+    def set_streaming(self, streaming: bool) -> None:
+        """
+        Mark whether a response is streaming into the output display.
+
+        While it is, Submit and the replay buttons are disabled, and replays or errors that come in meanwhile
+        are displayed once the response is complete, so that their output does not interleave with it.
+
+        Args:
+            streaming (bool): Whether a response is streaming.
+        """
+        self._streaming = streaming
+        for button in (self.submit_button, self.replay_button, self.batch_replay_button):
+            button.setEnabled(not streaming)
+        if not streaming:
+            deferred, self._deferred_output = self._deferred_output, []
+            for show in deferred:
+                show()
 
-            self.chat_history.append({"role": "assistant", "content": response})
-            ai_entry = f"AI [{self.get_timestamp()}]: {response}"
-            self.append_to_output(ai_entry, is_ai=True)
+    def show_replay(self, prompts: List[str], future: Future) -> None:
+        """
+        Display the AI responses of a bulk replay.
 
+        Args:
+            prompts (List[str]): The replayed prompts.
+            future (Future): The finished request returning one response (or exception) per prompt.
+        """
+        if self._streaming:
+            self._deferred_output.append(lambda: self.show_replay(prompts, future))
+            return
+        timestamp = self.get_timestamp()
+        try:
+            responses = future.result()
+        except Exception as e:
+            self.append_to_output(format_entry("Error", timestamp, str(e)))
             self.append_to_output("===")
-            self.store_chat_history(user_entry, ai_entry)
+            return
+
+        lines = []
+        for prompt, response in zip(prompts, responses):
+            lines.append((format_entry("Replay", timestamp, prompt), False))
+            if isinstance(response, Exception):
+                lines.append((format_entry("Error", timestamp, str(response)), False))
+            else:
+                lines.append((format_entry("AI", timestamp, response), True))
+        lines.append(("===", False))
+        self.append_lines_to_output(lines)
 
     def append_to_output(self, text: str, is_ai: bool = False) -> None:
         """
-        Append text to the output display with optional AI-specific formatting.
+        Append a line to the output display with optional AI-specific formatting.
+
+        Streamed text is added to the end of the line with `append_many_to_output`.
 
         Args:
             text (str): The text to append.
             is_ai (bool): Whether the text is from AI, applying color formatting if True.
         """
+        self.output_area.append(_html_span(text, self.AI_COLOR if is_ai else self.USER_COLOR))
+
+    def append_lines_to_output(self, lines: List[Tuple[str, bool]]) -> None:
+        """
+        Append several lines to the output display in a single call.
+
+        Args:
+            lines (List[Tuple[str, bool]]): The lines to append and whether each is from AI.
+        """
+        self.output_area.append('<br>'.join(
+            _html_span(text, self.AI_COLOR if is_ai else self.USER_COLOR) for text, is_ai in lines
+        ))
+
+    def append_many_to_output(self, chunks: List[Tuple[str, bool]]) -> None:
+        """
+        Insert several pieces of text at the end of the output display in a single call, continuing the last line.
+
+        Args:
+            chunks (List[Tuple[str, bool]]): The text to insert, including any line breaks, and whether it is from AI.
+        """
         cursor = self.output_area.textCursor
         cursor.movePosition(pya.QTextCursor.End)
-        if is_ai:
-            self.output_area.setTextColor(pya.QColor("green"))
-        else:
-            self.output_area.setTextColor(pya.QColor("black"))
-        cursor.insertText(text + '\n')
+        cursor.insertHtml(''.join(
+            _html_span(text, self.AI_COLOR if is_ai else self.USER_COLOR) for text, is_ai in chunks
+        ))
         self.output_area.setTextCursor(cursor)
 
     def get_timestamp(self) -> str:
@@ -221,62 +1553,204 @@ class kai_ui(pya.QDialog):
         Returns:
             str: The current timestamp in 'YYYY-MM-DD HH:MM:SS' format.
         """
-        return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        return time.strftime('%Y-%m-%d %H:%M:%S')
 
-    def store_chat_history(self, user_entry: str, ai_entry: str) -> None:
+    def store_chat_history(self, timestamp: str, prompt: str, response: str) -> None:
         """
-        Save the current chat history entries to a file.
+        Append an exchange to this session's complete JSONL history on the I/O thread.
+
+        The file is opened on first use and kept open with a large buffer; it is flushed periodically by the
+        flush timer and closed with the dialog.
 
         Args:
-            user_entry (str): The user's message entry.
-            ai_entry (str): The AI's message entry.
+            timestamp (str): The timestamp of the exchange.
+            prompt (str): The user's prompt.
+            response (str): The AI's response.
         """
-        self.history_dir.mkdir(exist_ok=True)
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        file_path = self.history_dir / f'kai_{timestamp}.txt'
+        records = [dump_record("user", timestamp, prompt), dump_record("assistant", timestamp, response)]
+        self.submit_io(self._write_chat_history, records, f"User: {prompt}".splitlines()[0])
+
+    def _write_chat_history(self, records: List[bytes], first_line: str) -> None:
+        """
+        Write records to this session's complete history, opening it if needed; runs on the I/O thread.
+
+        Args:
+            records (List[bytes]): The encoded records to append, starting with a user prompt.
+            first_line (str): The summary line of the exchange, recorded in index.json for a new complete history.
+        """
+        if self._complete_file is None:
+            self.history_dir.mkdir(exist_ok=True)
+            # Index first, so the history list finds the summary when the new file appears
+            update_history_index(self.history_dir, self._complete_path.stem, first_line, 1)
+            self._complete_file = open(self._complete_path, 'ab', buffering=1 << 16)
+        for record in records:
+            self._complete_offsets.append(self._complete_size)
+            self._complete_size += len(record)
+            self._complete_file.write(record)
+        self._complete_turns += 1
+
+    def submit_io(self, fn: Callable, *args) -> Future:
+        """
+        Run a chat history write on the I/O thread, reporting a failure in the output display.
+
+        Args:
+            fn (Callable): The function to run.
+            *args: The arguments of `fn`.
+
+        Returns:
+            Future: The submitted job.
+        """
+        job = self._io_executor.submit(fn, *args)
+        job.add_done_callback(self._report_io_error)
+        return job
+
+    def _report_io_error(self, job: Future) -> None:
+        """
+        Report a failed chat history write on the console and queue it for display; runs on the I/O thread.
+
+        Args:
+            job (Future): The finished job.
+        """
+        error = None if job.cancelled() else job.exception()
+        if error is not None:
+            print(f"kAI: failed to save the chat history: {error!r}", file=sys.stderr)
+            self._ui_calls.put(lambda: self.show_io_error(error))
 
-        with open(file_path, 'a') as file:
-            file.write(user_entry + '\n')
-            file.write(ai_entry + '\n')
-            file.write("===\n")
+    def show_io_error(self, error: BaseException) -> None:
+        """
+        Display a failed chat history write.
+
+        Args:
+            error (BaseException): The error raised by the write.
+        """
+        if self._streaming:
+            self._deferred_output.append(lambda: self.show_io_error(error))
+            return
+        self.append_to_output(format_entry("Error", self.get_timestamp(), f"Chat history not saved: {error}"))
+
+    def flush_chat_history(self) -> None:
+        """Flush buffered chat history entries to disk on the I/O thread; runs from the flush timer."""
+        if self._complete_file is not None:
+            self.submit_io(self._complete_file.flush)
+        if not self._ui_calls.empty():
+            self._response_timer.start()  # show errors reported by the I/O thread
+
+    def _close_chat_history(self) -> None:
+        """
+        Close this session's complete history; runs on the I/O thread.
+
+        The record offsets of the complete history are saved to its '.idx' sidecar, which lets the history
+        viewer page through the file without scanning it, and its prompt count is recorded in index.json.
+        The finished file is then compressed with zstd, when available. Only this session's file is
+        compressed, since histories of other sessions may still be open in another dialog.
+        """
+        if self._complete_file is not None:
+            self._complete_file.close()
+            self._complete_file = None
+            self._complete_path.with_suffix('.idx').write_bytes(self._complete_offsets.tobytes())
+            index_path = self.history_dir / 'index.json'
+            index = json.loads(index_path.read_text()) if index_path.exists() else {}
+            entry = index.get(self._complete_path.stem)
+            if entry and entry['turns'] != self._complete_turns:
+                update_history_index(
+                    self.history_dir, self._complete_path.stem, entry['first_line'], self._complete_turns
+                )
+            if zstandard:
+                compress_file(self._complete_path)
 
     def load_history_files(self) -> None:
-        """Load chat history files from the history directory."""
-        self.history_list.clear()
+        """
+        Sync the history list with the complete chat history files in the history directory.
+
+        The directory is scanned every time: its modification time only changes in whole kernel ticks, so a
+        file created in the same tick as the previous scan would be missed. The list model is only reset when
+        files were added or removed. Entries get a tooltip with the summary recorded in the directory's
+        index.json.
+        """
+        current = {}
         if self.history_dir.exists():
-            for file in self.history_dir.glob("*complete*.txt"):
-                self.history_list.addItem(file.stem)
+            with os.scandir(self.history_dir) as entries:
+                for entry in entries:
+                    if 'complete' in entry.name and entry.name.endswith(_HISTORY_SUFFIXES) and entry.is_file():
+                        current[entry.name.split('.', 1)[0]] = entry.name
+
+        changed = current.keys() != self._history_cache.keys()
+        self._history_cache = current
+        if changed:
+            index_path = self.history_dir / 'index.json'
+            index = json.loads(index_path.read_text()) if index_path.exists() else {}
+            tooltips = {
+                name: f"{index[name]['first_line']}\n{index[name]['turns']} prompt(s)"
+                for name in current if name in index
+            }
+            self.history_model.set_names(sorted(current), tooltips)
+
+    def selected_history_path(self) -> Optional[Path]:
+        """
+        Return the path of the chat history file selected in the history list.
+
+        Returns:
+            Path: The selected file, or None if nothing is selected.
+        """
+        index = self.history_list.currentIndex
+        if index.isValid():
+            name = self.history_model.name(index.row())
+            if name in self._history_cache:
+                return self.history_dir / self._history_cache[name]
+        return None
+
+    def on_history_dir_changed(self, path: str) -> None:
+        """
+        Handle a change in the watched history directory.
+
+        Args:
+            path (str): The changed directory.
+        """
+        self.load_history_files()
 
     def load_selected_history(self) -> None:
-        """Load the selected chat history file and display its contents in a new dialog."""
-        selected_item = self.history_list.currentItem
-        if selected_item:
-            file_name = selected_item.text
-            file_path = self.history_dir / f"{file_name}.txt"
-            if file_path.exists():
-                with open(file_path, 'r') as file:
-                    history_content = file.read()
+        """Display the selected chat history file in a new dialog, loading entries as they are scrolled into view."""
+        file_path = self.selected_history_path()
+        if file_path and file_path.exists():
+            history_dialog = pya.QDialog(self)
+            history_dialog.setWindowTitle(f"Chat History - {file_path.name}")
+            history_dialog.resize(600, 400)
+
+            history_model = TranscriptModel(file_path, self.history_dir / f"{file_path.name.split('.', 1)[0]}.idx")
+            history_view = pya.QListView(history_dialog)
+            history_view.setWordWrap(True)
+            history_view.setAlternatingRowColors(True)
+            history_view.setModel(history_model)
 
-                history_dialog = pya.QDialog(self)
-                history_dialog.setWindowTitle(f"Chat History - {file_name}")
-                history_dialog.resize(600, 400)
+            dialog_layout = pya.QVBoxLayout(history_dialog)
+            dialog_layout.addWidget(history_view)
+            history_dialog.setLayout(dialog_layout)
 
-                history_text = pya.QTextEdit(history_dialog)
-                history_text.setReadOnly(True)
-                history_text.setText(history_content)
+            history_dialog.exec_()
+            history_model.close()
 
-                dialog_layout = pya.QVBoxLayout(history_dialog)
-                dialog_layout.addWidget(history_text)
-                history_dialog.setLayout(dialog_layout)
+    def replay_selected_history(self) -> None:
+        """Re-send the user prompts of the selected chat history file to OpenAI concurrently."""
+        file_path = self.selected_history_path()
+        if file_path and file_path.exists():
+            self.bulk_submit(read_user_prompts(file_path))
+
+    def batch_replay_selected_history(self) -> None:
+        """
+        Re-send the user prompts of the selected chat history file through the OpenAI Batch API.
 
-                history_dialog.exec_()
+        Batches cost less but may take up to 24 hours; the responses are displayed once the batch completes,
+        in this session or the next one.
+        """
+        file_path = self.selected_history_path()
+        if file_path and file_path.exists():
+            self.batch_submit(read_user_prompts(file_path))
 
     def view_config_file(self) -> None:
         """Display the contents of the config.yml file in a new dialog."""
-        config_path = Path(__file__).parent.parent / 'config.yml'
+        config_path = CONFIG_PATH
         if config_path.exists():
-            with open(config_path, 'r') as file:
-                config_content = file.read()
+            config_content = read_text(config_path)
 
             config_dialog = pya.QDialog(self)
             config_dialog.setWindowTitle(f"Config - {str(config_path)}")
@@ -293,18 +1767,21 @@ class kai_ui(pya.QDialog):
             config_dialog.exec_()
 
     def closeEvent(self, event: pya.QCloseEvent) -> None:
-        """Handle the close event by saving the complete chat history."""
-        if self.chat_history:
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            file_path = self.history_dir / f'kai_complete_{timestamp}.txt'
-
-            formatted_history = [
-                f"{message['role'].capitalize()} [{self.get_timestamp()}]: {message['content']}"
-                for message in self.chat_history
-            ]
+        """
+        Handle the close event by closing the chat history file.
 
-            with open(file_path, 'w') as file:
-                file.write("\n".join(formatted_history))
+        Pending writes finish on the I/O thread; closing waits for them for at most half a second, after which
+        they complete in the background.
+        """
+        self._response_timer.stop()
+        self._flush_timer.stop()
+        self._prefetch_timer.stop()
+        self._batch_timer.stop()
+        if self._speculative is not None:
+            self._speculative[1].cancel()
+        close_job = self.submit_io(self._close_chat_history)
+        self._io_executor.shutdown(wait=False)
+        wait([close_job], timeout=0.5)
 
         event.accept()
 